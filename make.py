@@ -43,6 +43,8 @@ import hashlib
 import configparser
 import json
 import traceback
+import zipfile
+import zlib
 
 if sys.version_info[0] == 2:
 	print("Python 3 is required.")
@@ -50,6 +52,13 @@ if sys.version_info[0] == 2:
 if sys.platform == "win32":
 	import winreg
 
+# Files AddonBuilder packs unchanged (passed to it with -include)
+ADDONBUILDER_INCLUDE = "*.pac;*.paa;*.sqf;*.sqs;*.bikb;*.fsm;*.wss;*.ogg;*.wav;*.fxy;*.csv;*.html;*.lip;*.txt;*.wrp;*.bisurf;*.xml;*.hqf;*.rtm;*.rvmat;*.shp;"
+# Files AddonBuilder binarizes into the PBO
+BINARIZED_EXTENSIONS = (".p3d", ".cpp", ".sqm")
+# Every file type that ends up in a built PBO
+PACKED_EXTENSIONS = tuple(x[1:] for x in ADDONBUILDER_INCLUDE.split(";") if x) + BINARIZED_EXTENSIONS
+
 ###############################################################################
 # External code
 ###############################################################################
@@ -159,6 +168,127 @@ if sys.platform == "win32":
 
 ###############################################################################
 
+def get_file_hash(f):
+	"""Returns hash of an open binary file, read in chunks."""
+	file_hash = hashlib.sha1()
+	while 1:
+		buf = f.read(65536)
+		if not buf:
+			break
+		file_hash.update(buf)
+	return file_hash.hexdigest()
+
+def get_release_manifest(release):
+	"""Returns {relative path: size} for a release directory or an open ZipFile.
+	Paths always use forward slashes so directories and archives compare."""
+	manifest = {}
+	if isinstance(release, zipfile.ZipFile):
+		for info in release.infolist():
+			if not info.filename.endswith("/"):
+				manifest[info.filename] = info.file_size
+	else:
+		for root, _, files in os.walk(release):
+			for current_file in files:
+				path = os.path.join(root, current_file)
+				manifest[os.path.relpath(path, release).replace(os.sep, "/")] = os.path.getsize(path)
+	return manifest
+
+def open_release_file(release, name):
+	"""Open a file from a release directory or an open ZipFile for reading."""
+	if isinstance(release, zipfile.ZipFile):
+		return release.open(name)
+	return open(os.path.join(release, *name.split("/")), 'rb')
+
+def diff_releases(old, new, extensions):
+	"""Compare two releases (directories or open ZipFiles) and return
+	(changed, removed) lists of relative paths with the given extensions.
+	Files are only hashed when their sizes match, and are streamed."""
+	old_manifest = get_release_manifest(old)
+	new_manifest = get_release_manifest(new)
+
+	changed = []
+	for name, size in sorted(new_manifest.items()):
+		if not name.lower().endswith(extensions):
+			continue
+		if name in old_manifest and old_manifest[name] == size:
+			with open_release_file(old, name) as f:
+				old_sha = get_file_hash(f)
+			with open_release_file(new, name) as f:
+				new_sha = get_file_hash(f)
+			if old_sha == new_sha:
+				continue
+		changed.append(name)
+
+	removed = sorted(name for name in old_manifest if name.lower().endswith(extensions) and not name in new_manifest)
+
+	return changed, removed
+
+def analyze_modules(modules, ignore, extensions = PACKED_EXTENSIONS, largest_count = 10, sample_size = 65536):
+	"""Scan {PBO name: module path} once and return a size report as a dict.
+	Only files with the given extensions are counted, and binarized files are
+	counted at their source size. Files are bucketed by size and only hashed
+	when sizes collide. Zip size is estimated by deflating the first
+	sample_size bytes of each file."""
+	report = {"pbos": {}, "duplicates": []}
+	report["note"] = "Sizes are of source files AddonBuilder packs; binarized files (%s) are counted at their source size." % ", ".join(BINARIZED_EXTENSIONS)
+	by_size = {}
+
+	for pbo, path in sorted(modules.items()):
+		files = []
+		zip_bytes = 0
+		for root, dirs, names in os.walk(path):
+			dirs[:] = [d for d in dirs if not d in ignore]
+			for current_file in names:
+				# Skip files the build does not pack
+				if not current_file.lower().endswith(extensions):
+					continue
+				full_path = os.path.join(root, current_file)
+				size = os.path.getsize(full_path)
+				files.append((size, os.path.relpath(full_path, path).replace(os.sep, "/")))
+				by_size.setdefault(size, []).append((pbo, full_path))
+
+				# Extrapolate the deflated size of the whole file from a sample
+				if size > 0:
+					with open(full_path, 'rb') as f:
+						sample = f.read(sample_size)
+					zip_bytes += int(size * len(zlib.compress(sample)) / len(sample))
+
+		files.sort(reverse=True)
+		report["pbos"][pbo] = {
+			"files": len(files),
+			"bytes": sum(size for size, _ in files),
+			"estimated_zip_bytes": zip_bytes,
+			"largest": [{"path": name, "bytes": size} for size, name in files[:largest_count]]
+		}
+
+	# Hash only the files that share a size with another file
+	for size, entries in by_size.items():
+		if size == 0 or len(entries) < 2:
+			continue
+		by_hash = {}
+		for pbo, full_path in entries:
+			with open(full_path, 'rb') as f:
+				by_hash.setdefault(get_file_hash(f), []).append((pbo, full_path))
+		for sha, copies in by_hash.items():
+			# Only report files duplicated across modules, counting one copy per PBO
+			pbos = set(pbo for pbo, _ in copies)
+			if len(pbos) < 2:
+				continue
+			report["duplicates"].append({
+				"sha1": sha,
+				"bytes": size,
+				"wasted_bytes": size * (len(pbos) - 1),
+				"files": sorted(pbo + "/" + os.path.relpath(full_path, modules[pbo]).replace(os.sep, "/") for pbo, full_path in copies)
+			})
+
+	report["duplicates"].sort(key=lambda d: d["wasted_bytes"], reverse=True)
+	report["duplicate_bytes"] = sum(d["wasted_bytes"] for d in report["duplicates"])
+	report["release_bytes"] = sum(p["bytes"] for p in report["pbos"].values())
+	report["estimated_zip_bytes"] = sum(p["estimated_zip_bytes"] for p in report["pbos"].values())
+	report["estimated_zip_ratio"] = round(report["estimated_zip_bytes"] / report["release_bytes"], 3) if report["release_bytes"] else 1.0
+
+	return report
+
 def color(color):
 	"""Set the color. Works on Win32 and normal terminals."""
 	if sys.platform == "win32":
@@ -203,12 +333,17 @@ def print_blue(msg):
 def print_help():
 	"""Prints help info on console usage of this program."""
 	print ("""
-make.py [help] [test] [force] [key <name>] [target <name>] [release <version>]
-        [module names ...]
+make.py [help] [test] [force] [analyze] [key <name>] [target <name>] [release <version>]
+        [since <old>] [module names ...]
 
 test -- Copy result to <Arma 3 location>\Mods folder.
 release <version> -- Make archive with <version>.
+since <old> -- With release, also make a patch archive with only the PBOs,
+   signatures and keys changed since <old>. <old> is a previous release
+   archive, release directory or version number.
 force -- Ignore cache and build all.
+analyze -- Do not build. Report duplicate files across modules, the largest
+   files per PBO and the estimated release size to <project>-analysis.json.
 target <name> -- Use rules in make.cfg under heading [<name>] rather than
    default [Make]
 key <name> -- Use key in working directory with <name> to sign. If it does not
@@ -226,9 +361,14 @@ Examples:
       directory.
    make.py mymodule_gun
       Only build the module named 'mymodule_gun'.
+   make.py analyze
+      Write a size and duplicate file report without building.
    make.py force key MyNewKey release 1.0
       Build all modules (ignoring cache), sign them with NewKey, and pack them
       into a zip file for release with version 1.0.
+   make.py release 1.1 since 1.0
+      Build and pack version 1.1, plus a patch archive against the version 1.0
+      release archive.
 
 """)
 
@@ -239,7 +379,7 @@ Examples:
 class Make:
 	"""Main class for building an Arma addon."""
 
-	def __init__(self, root, target = "DEFAULT", modules = None, release = False, version = None, test = False, force = False, key = None, quiet = True):
+	def __init__(self, root, target = "DEFAULT", modules = None, release = False, version = None, test = False, force = False, key = None, quiet = True, since = None, analyze = False):
 		self.root = root
 
 		# Constructor parameters
@@ -251,8 +391,11 @@ class Make:
 		self.version = version
 		self.key = key
 		self.quiet = quiet
+		self.since = since
 
-		self.find_tools()
+		# Analyzing only reads the modules, so it does not need the BI tools
+		if not analyze:
+			self.find_tools()
 		self.init_cache()
 
 		self.parse_config()
@@ -260,6 +403,13 @@ class Make:
 		if self.module_autodetect:
 			self.autodetect_modules()
 
+		# Find the old release before building, so a bad 'since' fails the run early.
+		self.old_release = None
+		if self.release and self.since:
+			self.old_release, self.since_name = self.find_old_release()
+			if not self.old_release:
+				sys.exit(1)
+
 	def parse_config(self):
 		"""Parse make.cfg values."""
 		cfg = configparser.ConfigParser()
@@ -302,6 +452,13 @@ class Make:
 		except:
 			print_error("make.cfg file is required.")
 
+		# Maximum bytes of files duplicated across modules before analyze fails
+		try:
+			self.duplicate_budget = cfg.getint(self.target, "duplicate_budget", fallback=None)
+		except ValueError:
+			print_error("duplicate_budget in make.cfg must be a whole number of bytes.")
+			sys.exit(1)
+
 	def find_tools(self):
 		"""Find tools needed to build modules."""
 
@@ -425,6 +582,87 @@ class Make:
 		except IOError:
 			print_error("Could not make release.")
 
+		# Make a patch against an older release if requested.
+		if self.old_release:
+			self.zip_patch(self.old_release)
+
+	def find_old_release(self):
+		"""Resolve the release given with 'since' to (archive or directory path, version label), or (None, None)."""
+		# Accept a release archive or directory, or the version of an archive made by zip_release.
+		old = self.since
+		since_name = self.since
+		if os.path.isfile(old):
+			# Name the patch after the old version, not its archive name
+			since_name = os.path.basename(old)
+			if since_name.lower().endswith(".zip"):
+				since_name = since_name[:-len(".zip")]
+			if since_name.startswith(self.project + "-"):
+				since_name = since_name[len(self.project + "-"):]
+		elif os.path.isdir(old):
+			since_name = os.path.basename(os.path.normpath(old))
+		else:
+			old = self.project + "-" + self.since + ".zip"
+		if not os.path.exists(old):
+			print_error("Could not find old release %s." % self.since)
+			return None, None
+
+		if os.path.abspath(old) == os.path.abspath(self.project + "-" + self.version + ".zip"):
+			print_error("Old release %s is the archive being made for version %s." % (self.since, self.version))
+			return None, None
+
+		return old, since_name
+
+	def zip_patch(self, old):
+		"""Zip up the PBOs, signatures and keys changed since an older release."""
+		since_name = self.since_name
+		patch_name = self.project + "-" + self.version + "-patch-" + since_name + ".zip"
+		print_blue("Zipping patch: " + patch_name)
+
+		try:
+			if os.path.isdir(old):
+				changed, removed = diff_releases(old, self.release_dir, (".pbo", ".bisign", ".bikey"))
+			else:
+				with zipfile.ZipFile(old) as old_zip:
+					changed, removed = diff_releases(old_zip, self.release_dir, (".pbo", ".bisign", ".bikey"))
+
+			with zipfile.ZipFile(patch_name, "w", zipfile.ZIP_DEFLATED) as patch_zip:
+				for name in changed:
+					patch_zip.write(os.path.join(self.release_dir, *name.split("/")), name)
+				# Manifest of files the patch replaces and the files to delete when applying it
+				patch_zip.writestr("patch.json", json.dumps({"version": self.version, "since": since_name, "changed": changed, "removed": removed}, indent=4))
+
+			print_green("Patch contains %d changed files and removes %d files." % (len(changed), len(removed)))
+		except (IOError, zipfile.BadZipFile):
+			print_error("Could not make patch.")
+
+	def analyze(self):
+		"""Write a size and duplicate file report for the modules. Returns False if over budget."""
+		print_blue("Analyzing %d modules." % len(self.modules))
+
+		modules = {}
+		for module in self.modules:
+			pbo = module.split(os.sep)[-1] + ".pbo"
+			if self.pbo_name_prefix:
+				pbo = self.pbo_name_prefix + pbo
+			modules[pbo] = os.path.join(self.project_root, module)
+
+		report = analyze_modules(modules, self.ignore)
+		report["project"] = self.project
+		report["duplicate_budget"] = self.duplicate_budget
+
+		report_path = os.path.join(self.root, self.project + "-analysis.json")
+		with open(report_path, 'w') as f:
+			f.write(json.dumps(report, indent=4))
+
+		print_green("Release size %d bytes, estimated %d bytes zipped (ratio %s)." % (report["release_bytes"], report["estimated_zip_bytes"], report["estimated_zip_ratio"]))
+		print_green("%d files duplicated across modules, wasting %d bytes." % (len(report["duplicates"]), report["duplicate_bytes"]))
+		print_blue("Report: " + report_path)
+
+		if self.duplicate_budget is not None and report["duplicate_bytes"] > self.duplicate_budget:
+			print_error("Duplicated bytes exceed budget of %d bytes." % self.duplicate_budget)
+			return False
+		return True
+
 	def copy_to_a3(self):
 		"""Copy built modules to Arma 3 folder for testing."""
 		print_blue("Copying addon to Arma 3 folder.")
@@ -518,9 +756,8 @@ class Make:
 				try:
 					if self.build_tool == "addonbuilder":
 						# Create temporary file with include list to feed to Addon Builder
-						include_list = "*.pac;*.paa;*.sqf;*.sqs;*.bikb;*.fsm;*.wss;*.ogg;*.wav;*.fxy;*.csv;*.html;*.lip;*.txt;*.wrp;*.bisurf;*.xml;*.hqf;*.rtm;*.rvmat;*.shp;"
 						with open(os.path.join(self.root, "~make.includes"), "w") as include_file:
-							include_file.write(include_list)
+							include_file.write(ADDONBUILDER_INCLUDE)
 						include = "-include=%s" % (os.path.join(self.root, "~make.includes"))
 
 						try:
@@ -632,7 +869,7 @@ def main(argv):
 	"""Build an Arma addon suite in a directory from rules in a make.cfg file."""
 	print_blue(("make for Arma 3, v%s" % __version__))
 
-	if sys.platform != "win32":
+	if sys.platform != "win32" and not "analyze" in argv:
 		print_error("Non-Windows platform (Cygwin?). Please re-run from cmd.")
 		sys.exit(1)
 
@@ -650,11 +887,17 @@ def main(argv):
 	test = False
 	release = False
 	version = None
+	since = None
+	analyze = False
 
 	if "force" in argv:
 		force = True
 		argv.remove("force")
 
+	if "analyze" in argv:
+		analyze = True
+		argv.remove("analyze")
+
 	if "test" in argv:
 		test = True
 		argv.remove("test")
@@ -665,6 +908,18 @@ def main(argv):
 		argv.remove(version)
 		argv.remove("release")
 
+	if "since" in argv:
+		since = argv[argv.index("since") + 1]
+		argv.remove("since")
+		argv.remove(since)
+
+		if not release:
+			print_error("since <old> requires release <version>.")
+			sys.exit(1)
+		if since == version:
+			print_error("since <old> must be an older version than release <version>.")
+			sys.exit(1)
+
 	if "target" in argv:
 		target = argv[argv.index("target") + 1]
 		argv.remove("target")
@@ -681,8 +936,12 @@ def main(argv):
 
 	# Create a new Make object and execute the build.
 	try:
-		make = Make(root, target = target, force = force, test = test, release = release, version = version)
-		make.make()
+		make = Make(root, target = target, force = force, test = test, release = release, version = version, since = since, analyze = analyze)
+		if analyze:
+			if not make.analyze():
+				sys.exit(1)
+		else:
+			make.make()
 	except:
 		raise
 